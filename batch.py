@@ -0,0 +1,95 @@
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from headless import render, display_list_json, layout_json
+from main import HeadlessFont, set_font_provider
+
+DEFAULT_TIMEOUT = 30
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+def on_alarm(signum, frame):
+    raise RenderTimeout()
+
+
+def init_worker():
+    set_font_provider(HeadlessFont)
+    signal.signal(signal.SIGALRM, on_alarm)
+    # pages log to stdout; keep that away from the JSON output
+    sys.stdout = sys.stderr
+
+
+def render_one(task):
+    url, timeout, dump = task
+    start = time.perf_counter()
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        tab = render(url)
+        if dump == "layout":
+            output = layout_json(tab.document)
+        else:
+            output = display_list_json(tab)
+        result = {"url": url, "ok": True, dump: output}
+    except RenderTimeout:
+        result = {"url": url, "ok": False, "error": "timed out after {}s".format(timeout)}
+    except Exception as e:
+        result = {"url": url, "ok": False, "error": repr(e)}
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result["ok"], json.dumps(result)
+
+
+def read_urls(path):
+    urls = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            if "://" not in line:
+                line = "file://" + os.path.abspath(line)
+            urls.append(line)
+    return urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render many pages headlessly.")
+    parser.add_argument("urls", help="file with one URL or local HTML path per line")
+    parser.add_argument("-o", "--output", help="JSON lines output file (default: stdout)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("-t", "--timeout", type=float, default=DEFAULT_TIMEOUT,
+                        help="seconds allowed per page")
+    parser.add_argument("--dump", choices=["display_list", "layout"], default="display_list")
+    args = parser.parse_args()
+
+    urls = read_urls(args.urls)
+    tasks = [(url, args.timeout, args.dump) for url in urls]
+    out = open(args.output, "w") if args.output else sys.stdout
+
+    start = time.perf_counter()
+    failed = 0
+    # recycle workers now and then so a leaky page can't bloat one for the whole run
+    with multiprocessing.Pool(args.workers, initializer=init_worker, maxtasksperchild=100) as pool:
+        for ok, line in pool.imap_unordered(render_one, tasks):
+            if not ok:
+                failed += 1
+            out.write(line + "\n")
+    elapsed = time.perf_counter() - start
+    if out is not sys.stdout:
+        out.close()
+
+    print("rendered {} pages ({} failed) in {:.1f}s with {} workers: {:.1f} pages/s".format(
+        len(urls), failed, elapsed, args.workers, len(urls) / elapsed if elapsed else 0),
+        file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
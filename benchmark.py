@@ -0,0 +1,282 @@
+import sys
+import time
+import tracemalloc
+
+from css_parser import CSSParser, RuleIndex, style, restyle, mark_style_dirty, cascade_priority, parse_selector
+from helpers import tree_to_list
+from html_parser import HTMLParser, DOMIndex, Text
+
+
+class LegacyHTMLParser(HTMLParser):
+    # the original character-at-a-time tokenizer and implicit_tags, kept for comparison
+    def parse(self):
+        text = ''
+        in_angle = False
+        for c in self.body:
+            if c == "<":
+                in_angle = True
+                if text: self.add_text(text)
+                text = ''
+            elif c == ">":
+                in_angle = False
+                self.add_tag(text)
+                text = ''
+            else:
+                text += c
+        if not in_angle and text:
+            self.add_text(text)
+        return self.finish()
+
+    def implicit_tags(self, tag):
+        while True:
+            open_tags = [node.tag for node in self.unfinished]
+            if open_tags == [] and tag != "html":
+                self.add_tag("html")
+            elif open_tags == ['html'] and tag not in ['head', 'body', '/html']:
+                if tag in self.HEAD_TAGS:
+                    self.add_tag("head")
+                else:
+                    self.add_tag("body")
+            elif open_tags == ['html', 'head'] and tag not in ['/head'] + self.HEAD_TAGS:
+                self.add_tag('/head')
+            else:
+                break
+
+
+MARKUP_PARAGRAPH = "<p class=intro>Lorem ipsum <b>dolor</b> sit amet, " \
+                   "<a href=/next>consectetur</a> adipiscing elit &amp; more.</p>\n"
+TEXT_PARAGRAPH = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 20 + "</p>\n"
+
+
+class LegacyText:
+    def __init__(self, text, parent):
+        self.text = text
+        self.parent = parent
+        self.children = []
+
+
+class LegacyElement:
+    def __init__(self, tag, attributes, parent):
+        self.tag = tag
+        self.parent = parent
+        self.attributes = attributes
+        self.children = []
+
+
+def fresh(s):
+    return (s + " ")[:-1]
+
+
+def legacy_copy(node, parent=None):
+    # rebuild a styled tree the way it used to be stored: a __dict__ per node,
+    # un-interned tag and attribute names, and a private style dict per node;
+    # strings are copied so both trees pay for their own text
+    if isinstance(node, Text):
+        copy = LegacyText(fresh(node.text), parent)
+    else:
+        attributes = {fresh(key): fresh(value) for key, value in node.attributes.items()}
+        copy = LegacyElement(fresh(node.tag), attributes, parent)
+    copy.style = dict(node.style)
+    copy.children = [legacy_copy(child, copy) for child in node.children]
+    return copy
+
+
+def generate_document(size, paragraph=MARKUP_PARAGRAPH):
+    out = ["<!doctype html><html><head><title>Benchmark</title></head><body>"]
+    length = len(out[0])
+    while length < size:
+        out.append(paragraph)
+        length += len(paragraph)
+    out.append("</body></html>")
+    return "".join(out)
+
+
+def best_time(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_parse(sizes=(1, 4, 16)):
+    print("HTML parse throughput (MB/s)")
+    print("{:>8} {:>8} {:>10} {:>10} {:>8}".format(
+        "content", "size", "legacy", "current", "speedup"))
+    for content, paragraph in [("markup", MARKUP_PARAGRAPH), ("text", TEXT_PARAGRAPH)]:
+        for mb in sizes:
+            body = generate_document(mb * 1024 * 1024, paragraph)
+            legacy = best_time(lambda: LegacyHTMLParser(body).parse())
+            current = best_time(lambda: HTMLParser(body).parse())
+            megabytes = len(body) / (1024 * 1024)
+            print("{:>8} {:>6}MB {:>10.2f} {:>10.2f} {:>7.1f}x".format(
+                content, mb, megabytes / legacy, megabytes / current, legacy / current))
+
+
+def generate_nested_document(depth):
+    return "<div>" * depth + "<p>deep</p>" + "</div>" * depth
+
+
+def bench_nesting(depths=(10000, 20000)):
+    print("Deeply nested parse time (ms)")
+    print("{:>8} {:>10} {:>10} {:>8}".format("depth", "legacy", "current", "speedup"))
+    for depth in depths:
+        body = generate_nested_document(depth)
+        legacy = best_time(lambda: LegacyHTMLParser(body).parse(), repeat=1)
+        current = best_time(lambda: HTMLParser(body).parse())
+        print("{:>8} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+            depth, legacy * 1000, current * 1000, legacy / current))
+
+
+def styled_document(body):
+    with open("browser.css") as f:
+        rules = sorted(CSSParser(f.read()).parse(), key=cascade_priority)
+    nodes = HTMLParser(body).parse()
+    style(nodes, RuleIndex(rules))
+    return nodes
+
+
+def bench_memory(paragraphs=20000):
+    print("DOM memory (bytes per node)")
+    body = generate_document(paragraphs * len(MARKUP_PARAGRAPH))
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    nodes = styled_document(body)
+    current = tracemalloc.get_traced_memory()[0] - before
+    count = len(tree_to_list(nodes, []))
+
+    before = tracemalloc.get_traced_memory()[0]
+    legacy = legacy_copy(nodes)
+    legacy_size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    print("{:>8} {:>10} {:>10} {:>8}".format("nodes", "legacy", "current", "saving"))
+    print("{:>8} {:>10.0f} {:>10.0f} {:>7.0%}".format(
+        count, legacy_size / count, current / count, 1 - current / legacy_size))
+
+
+class LinearRules(RuleIndex):
+    # every rule is a candidate for every node, as before the rule index
+    def candidates(self, node):
+        return self.rules
+
+
+AUTHOR_TAGS = ["div", "span", "p", "a", "b", "i", "ul", "li", "section", "article",
+               "header", "footer", "nav", "h1", "h2", "h3", "table", "td", "tr", "em"]
+
+
+def generate_stylesheet(count):
+    out = []
+    for i in range(count):
+        tag = AUTHOR_TAGS[i % len(AUTHOR_TAGS)] + str(i // len(AUTHOR_TAGS))
+        if i % 3 == 0:
+            tag = AUTHOR_TAGS[(i // 3) % len(AUTHOR_TAGS)] + " " + tag
+        out.append("%s { color: blue; }" % tag)
+    return "\n".join(out)
+
+
+def bench_style(rule_counts=(500, 2000)):
+    print("Style time for a 512KB document (ms)")
+    print("{:>8} {:>10} {:>10} {:>8}".format("rules", "linear", "indexed", "speedup"))
+    nodes = HTMLParser(generate_document(512 * 1024)).parse()
+    with open("browser.css") as f:
+        default_rules = CSSParser(f.read()).parse()
+    for count in rule_counts:
+        rules = default_rules + CSSParser(generate_stylesheet(count)).parse()
+        rules = sorted(rules, key=cascade_priority)
+        linear = best_time(lambda: style(nodes, LinearRules(rules)), repeat=1)
+        indexed = best_time(lambda: style(nodes, RuleIndex(rules)))
+        print("{:>8} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+            count, linear * 1000, indexed * 1000, linear / indexed))
+
+
+class NoAncestorFilter:
+    # lets every descendant rule through to a full parent-chain walk
+    def push(self, node): pass
+    def pop(self, node): pass
+    def may_contain_all(self, keys): return True
+
+
+def generate_deep_document(sections, depth):
+    section = "<div>" * depth + "<p>deep <b>text</b></p>" + "</div>" * depth
+    return "<html><body>" + section * sections + "</body></html>"
+
+
+def bench_descendant(rule_counts=(100, 500)):
+    print("Style time with descendant rules on a deep DOM (ms)")
+    print("{:>8} {:>10} {:>10} {:>8}".format("rules", "no filter", "bloom", "speedup"))
+    nodes = HTMLParser(generate_deep_document(50, 100)).parse()
+    for count in rule_counts:
+        # descendant rules on tags present in the page, under ancestors that are not
+        text = "\n".join("nav%d div p { color: red; } aside%d b { color: blue; }" % (i, i)
+                         for i in range(count))
+        rules = RuleIndex(sorted(CSSParser(text).parse(), key=cascade_priority))
+        plain = best_time(lambda: style(nodes, rules, NoAncestorFilter()), repeat=1)
+        bloom = best_time(lambda: style(nodes, rules))
+        print("{:>8} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+            count * 2, plain * 1000, bloom * 1000, plain / bloom))
+
+
+def bench_restyle():
+    print("Restyle after editing one node in a 512KB document (ms)")
+    print("{:>10} {:>10} {:>8}".format("full", "dirty", "speedup"))
+    nodes = HTMLParser(generate_document(512 * 1024) + "<input name=q>").parse()
+    with open("browser.css") as f:
+        rules = RuleIndex(sorted(CSSParser(f.read()).parse(), key=cascade_priority))
+    style(nodes, rules)
+    edited = tree_to_list(nodes, [])[-1]
+
+    def edit():
+        edited.attributes["value"] = edited.attributes.get("value", "") + "x"
+        mark_style_dirty(edited)
+        restyle(nodes, rules)
+
+    full = best_time(lambda: style(nodes, rules))
+    dirty = best_time(edit)
+    print("{:>10.1f} {:>10.3f} {:>7.0f}x".format(full * 1000, dirty * 1000, full / dirty))
+
+
+def bench_query(queries=100):
+    print("querySelectorAll on a 128KB document, {} calls (ms)".format(queries))
+    print("{:>12} {:>8} {:>10} {:>10} {:>8}".format("selector", "matches", "scan", "indexed", "speedup"))
+    index = DOMIndex()
+    nodes = HTMLParser(generate_document(128 * 1024) + "<div id=footer><a>x</a></div>", index=index).parse()
+    for text in ["#footer", "#footer a", ".intro", "b"]:
+        def scan():
+            for i in range(queries):
+                selector = CSSParser(text).selector()
+                found = [node for node in tree_to_list(nodes, []) if selector.matches(node)]
+            return found
+
+        def indexed():
+            for i in range(queries):
+                selector = parse_selector(text)
+                found = [node for node in index.lookup(selector.key) if selector.matches(node)]
+            return found
+
+        assert scan() == indexed()
+        slow = best_time(scan, repeat=1)
+        fast = best_time(indexed)
+        print("{:>12} {:>8} {:>10.1f} {:>10.1f} {:>7.0f}x".format(
+            text, len(indexed()), slow * 1000, fast * 1000, slow / fast))
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "nesting": bench_nesting,
+    "memory": bench_memory,
+    "style": bench_style,
+    "descendant": bench_descendant,
+    "restyle": bench_restyle,
+    "query": bench_query,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -1,4 +1,6 @@
-from html_parser import Element
+from functools import lru_cache
+
+from html_parser import Element, node_keys, mark_children_dirty
 
 INHERITED_PROPERTIES = {
     "font-size": "16px",
@@ -65,12 +67,19 @@ class CSSParser:
             else:
                 self.i += 1
 
+    def simple_selector(self):
+        word = self.word()
+        if word.startswith("#"):
+            return IdSelector(word[1:])
+        elif word.startswith("."):
+            return ClassSelector(word[1:])
+        return TagSelector(word.lower())
+
     def selector(self):
-        out = TagSelector(self.word().lower())
+        out = self.simple_selector()
         self.whitespace()
         while self.i < len(self.s) and self.s[self.i] != '{':
-            tag = self.word()
-            descendant = TagSelector(tag.lower())
+            descendant = self.simple_selector()
             out = DescendantSelector(out, descendant)
             self.whitespace()
         return out
@@ -99,17 +108,51 @@ class CSSParser:
 class TagSelector:
     def __init__(self, tag):
         self.tag = tag
+        self.key = tag
+        self.ancestor_keys = []
         self.priority = 1
 
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
 
 
+class IdSelector:
+    def __init__(self, id):
+        self.id = id
+        self.key = "#" + id
+        self.ancestor_keys = []
+        self.priority = 100
+
+    def matches(self, node):
+        return isinstance(node, Element) and node.attributes.get("id") == self.id
+
+
+class ClassSelector:
+    def __init__(self, name):
+        self.name = name
+        self.key = "." + name
+        self.ancestor_keys = []
+        self.priority = 10
+
+    def matches(self, node):
+        return isinstance(node, Element) and self.name in node.attributes.get("class", "").split()
+
+
+# selectors are immutable once parsed, so scripts querying the same text share one
+@lru_cache(maxsize=1024)
+def parse_selector(text):
+    return CSSParser(text).selector()
+
+
 class DescendantSelector:
     def __init__(self, ancestor, descendant):
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        # rules are indexed by what the rightmost compound selector requires
+        self.key = descendant.key
+        # and can be rejected early unless all of these appear among the ancestors
+        self.ancestor_keys = ancestor.ancestor_keys + [ancestor.key] + descendant.ancestor_keys
 
     def matches(self, node):
         if not self.descendant.matches(node): return False
@@ -119,7 +162,138 @@ class DescendantSelector:
         return False
 
 
-def style(node, rules):
+class RuleIndex:
+    # rules must already be in cascade order; each bucket keeps that order
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_key = {}
+        self.positions = {}
+        # computed styles are shared between the nodes styled with this index that have
+        # identical values, so they must be treated as read-only once assigned
+        self.shared_styles = {}
+        for i, (selector, body) in enumerate(rules):
+            self.by_key.setdefault(selector.key, []).append((selector, body))
+            self.positions.setdefault(selector.key, []).append(i)
+
+    def candidates(self, node):
+        if not isinstance(node, Element): return []
+        keys = [key for key in node_keys(node) if key in self.by_key]
+        if len(keys) == 1:
+            return self.by_key[keys[0]]
+        elif not keys:
+            return []
+        # an element matching several keys gets their buckets merged back into cascade order
+        positions = sorted(i for key in keys for i in self.positions[key])
+        return [self.rules[i] for i in positions]
+
+    def shared_style(self, computed):
+        key = tuple(sorted(computed.items()))
+        shared = self.shared_styles.get(key)
+        if shared is None:
+            shared = self.shared_styles[key] = computed
+        return shared
+
+
+ANCESTOR_FILTER_BITS = 12
+
+
+class AncestorFilter:
+    # a counting bloom filter over the keys of the nodes above the one being styled
+    def __init__(self):
+        self.mask = (1 << ANCESTOR_FILTER_BITS) - 1
+        self.counts = [0] * (1 << ANCESTOR_FILTER_BITS)
+
+    def slots(self, key):
+        h = hash(key)
+        return h & self.mask, (h >> ANCESTOR_FILTER_BITS) & self.mask
+
+    def push(self, node):
+        if not isinstance(node, Element): return
+        for key in node_keys(node):
+            for slot in self.slots(key):
+                self.counts[slot] += 1
+
+    def pop(self, node):
+        if not isinstance(node, Element): return
+        for key in node_keys(node):
+            for slot in self.slots(key):
+                self.counts[slot] -= 1
+
+    def may_contain_all(self, keys):
+        counts = self.counts
+        for key in keys:
+            a, b = self.slots(key)
+            if not counts[a] or not counts[b]: return False
+        return True
+
+
+def ancestor_filter(node):
+    ancestors = AncestorFilter()
+    chain = []
+    while node.parent:
+        node = node.parent
+        chain.append(node)
+    for node in reversed(chain):
+        ancestors.push(node)
+    return ancestors
+
+
+def style(node, rules, ancestors=None):
+    if ancestors is None:
+        ancestors = ancestor_filter(node)
+
+    compute_style(node, rules, ancestors)
+    node.style_dirty = False
+    node.children_dirty = False
+
+    ancestors.push(node)
+    for child in node.children:
+        style(child, rules, ancestors)
+    ancestors.pop(node)
+
+
+# restyle only dirty nodes, plus the descendants of any node whose style changed;
+# returns whether any style in the subtree changed, marking the path layout-dirty
+def restyle(node, rules, ancestors=None):
+    if ancestors is None:
+        ancestors = ancestor_filter(node)
+
+    changed = False
+    if node.style_dirty:
+        old_style = node.style
+        compute_style(node, rules, ancestors)
+        node.style_dirty = False
+        # shared styles make identity a cheap equality check
+        changed = node.style is not old_style
+
+    subtree_changed = changed
+    if changed or node.children_dirty:
+        node.children_dirty = False
+        ancestors.push(node)
+        for child in node.children:
+            if changed: child.style_dirty = True
+            if child.style_dirty or child.children_dirty:
+                if restyle(child, rules, ancestors):
+                    subtree_changed = True
+        ancestors.pop(node)
+
+    if subtree_changed:
+        node.layout_dirty = True
+    return subtree_changed
+
+
+def mark_style_dirty(node):
+    node.style_dirty = True
+    mark_children_dirty(node.parent)
+
+
+def mark_layout_dirty(node):
+    while node:
+        node.layout_dirty = True
+        node = node.parent
+
+
+def compute_style(node, rules, ancestors):
     node.style = {}
     for prop, default_value in INHERITED_PROPERTIES.items():
         if node.parent:
@@ -127,7 +301,9 @@ def style(node, rules):
         else:
             node.style[prop] = default_value
 
-    for selector, body in rules:
+    for selector, body in rules.candidates(node):
+        if selector.ancestor_keys and not ancestors.may_contain_all(selector.ancestor_keys):
+            continue
         if not selector.matches(node): continue
         for prop, value in body.items():
             node.style[prop] = value
@@ -147,8 +323,7 @@ def style(node, rules):
         parent_px = float(parent_font_size[:-2])
         node.style['font-size'] = str(node_pct * parent_px) + 'px'
 
-    for child in node.children:
-        style(child, rules)
+    node.style = rules.shared_style(node.style)
 
 
 def cascade_priority(rule):
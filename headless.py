@@ -0,0 +1,46 @@
+import json
+import sys
+
+from main import Tab, HeadlessFont, set_font_provider
+
+
+def render(url):
+    tab = Tab()
+    tab.load(url)
+    return tab
+
+
+def display_list_json(tab):
+    return [cmd.as_dict() for cmd in tab.display_list]
+
+
+def screenshot(tab, path):
+    tiles = tab.tile_cache()
+    tiles.composite(0, tab.document.height).save(path)
+
+
+def layout_json(obj):
+    out = {
+        "type": type(obj).__name__,
+        "x": obj.x,
+        "y": obj.y,
+        "width": obj.width,
+        "height": obj.height,
+    }
+    if hasattr(obj, "word"):
+        out["word"] = obj.word
+    if obj.children:
+        out["children"] = [layout_json(child) for child in obj.children]
+    return out
+
+
+if __name__ == "__main__":
+    set_font_provider(HeadlessFont)
+    tab = render(sys.argv[1])
+    if len(sys.argv) > 2 and sys.argv[2].endswith(".png"):
+        screenshot(tab, sys.argv[2])
+        sys.exit()
+    out = open(sys.argv[2], "w") if len(sys.argv) > 2 else sys.stdout
+    for cmd in display_list_json(tab):
+        out.write(json.dumps(cmd) + "\n")
+    out.close()
@@ -1,5 +1,27 @@
 def tree_to_list(tree, list):
-    list.append(tree)
-    for child in tree.children:
-        tree_to_list(child, list)
+    # iterative pre-order walk so deeply nested documents don't hit the recursion limit
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        list.append(node)
+        stack.extend(reversed(node.children))
     return list
+
+
+class SpatialIndex:
+    # buckets items into fixed-height bands so a vertical range query only
+    # looks at the items near it; results keep the original list order
+    def __init__(self, items, bounds, band=256):
+        self.items = items
+        self.band = band
+        self.bands = {}
+        for i, item in enumerate(items):
+            top, bottom = bounds(item)
+            for b in range(int(top // band), int(bottom // band) + 1):
+                self.bands.setdefault(b, []).append(i)
+
+    def query(self, top, bottom):
+        found = set()
+        for b in range(int(top // self.band), int(bottom // self.band) + 1):
+            found.update(self.bands.get(b, ()))
+        return [self.items[i] for i in sorted(found)]
@@ -1,5 +1,10 @@
+import sys
+from bisect import bisect_left
+from fractions import Fraction
 from html import unescape
 
+from helpers import tree_to_list
+
 HTML_ENTITIES = {
     '&quot;': '"',
     '&apos;': "'",
@@ -10,28 +15,133 @@ HTML_ENTITIES = {
 }
 
 class Text:
+    __slots__ = ["text", "parent", "children", "style", "style_dirty", "children_dirty", "layout_dirty",
+                 "__weakref__"]
+
     def __init__(self, text, parent):
         self.text = text
         self.parent = parent
-        self.children = []
+        # text nodes never have children, so they all share one empty tuple
+        self.children = ()
+        self.style = None
+        self.style_dirty = True
+        self.children_dirty = False
+        self.layout_dirty = True
 
     def __repr__(self):
         return repr(self.text)
 
 class Element:
+    __slots__ = ["tag", "attributes", "parent", "children", "style", "style_dirty", "children_dirty", "layout_dirty",
+                 "order", "__weakref__"]
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.parent = parent
         self.attributes = attributes
         self.children = []
+        self.style = None
+        self.style_dirty = True
+        self.children_dirty = False
+        self.layout_dirty = True
+        # position in document order, while the element is in a DOMIndex
+        self.order = None
 
     def __repr__(self):
         return "<" + self.tag + ">"
 
+
+def mark_children_dirty(node):
+    # ancestors of a node with children_dirty set always have it set too
+    while node and not node.children_dirty:
+        node.children_dirty = True
+        node = node.parent
+
+
+# the keys a selector can be indexed under: tag, #id and .class
+def node_keys(node):
+    keys = [node.tag]
+    if "id" in node.attributes:
+        keys.append("#" + node.attributes["id"])
+    if "class" in node.attributes:
+        keys.extend("." + name for name in node.attributes["class"].split())
+    return keys
+
+
+class DOMIndex:
+    # maps every key of every element in a document to its elements in document order.
+    # the parser appends with integer orders; subtrees inserted later get fractions
+    # between their neighbours, so existing orders never have to be renumbered
+    def __init__(self):
+        self.next_order = 0
+        # key -> (sorted orders, elements in the same order)
+        self.by_key = {}
+
+    def lookup(self, key):
+        entry = self.by_key.get(key)
+        return entry[1] if entry else []
+
+    def add(self, node, order=None):
+        if order is None:
+            order = self.next_order
+            self.next_order += 1
+        node.order = order
+        for key in node_keys(node):
+            orders, nodes = self.by_key.setdefault(key, ([], []))
+            i = bisect_left(orders, order)
+            orders.insert(i, order)
+            nodes.insert(i, node)
+
+    def remove(self, node):
+        if node.order is None: return
+        for key in node_keys(node):
+            orders, nodes = self.by_key[key]
+            i = bisect_left(orders, node.order)
+            del orders[i]
+            del nodes[i]
+            # keys such as generated ids would otherwise pile up forever
+            if not orders:
+                del self.by_key[key]
+        node.order = None
+
+    def remove_subtree(self, node):
+        for child in tree_to_list(node, []):
+            if isinstance(child, Element):
+                self.remove(child)
+
+    # indexes the descendants of an indexed element, after its children were replaced
+    def add_children(self, node):
+        if node.order is None: return
+        added = [child for child in tree_to_list(node, [])[1:] if isinstance(child, Element)]
+        low, high = node.order, self.following_order(node)
+        step = Fraction(high - low) / (len(added) + 1)
+        for i, child in enumerate(added):
+            self.add(child, low + step * (i + 1))
+
+    def following_order(self, node):
+        while node.parent:
+            siblings = node.parent.children
+            for sibling in siblings[siblings.index(node) + 1:]:
+                if isinstance(sibling, Element):
+                    return sibling.order
+            node = node.parent
+        return self.next_order
+
+# insertion modes, derived from the open element stack as it changes
+BEFORE_HTML = "before html"
+BEFORE_HEAD = "before head"
+IN_HEAD = "in head"
+IN_BODY = "in body"
+
 class HTMLParser:
-    def __init__(self, body):
+    def __init__(self, body="", on_subresource=None, index=None):
         self.body = body
+        # the unconsumed tail of the fed data: an unterminated tag, or text that may continue
+        self.pending = []
         self.unfinished = []
+        self.mode = BEFORE_HTML
+        self.on_subresource = on_subresource
+        self.index = index
 
     SELF_CLOSING_TAGS = [
         "area", "base", "br", "col", "embed", "hr", "img", "input",
@@ -42,35 +152,65 @@ class HTMLParser:
         "link", "meta", "title", "style", "script",
     ]
     def parse(self):
-        text = ''
-        in_angle = False
-        for c in self.body:
-            if c == "<":
-                in_angle = True
-                if text: self.add_text(text)
-                text = ''
-            elif c == ">":
-                in_angle = False
-                self.add_tag(text)
-                text = ''
+        self.feed(self.body)
+        return self.close()
+
+    def feed(self, data):
+        if self.pending:
+            # earlier data was already searched, so only look for the pending token's end in the new data
+            in_tag = self.pending[0].startswith("<")
+            end = data.find(">" if in_tag else "<")
+            if end == -1:
+                self.pending.append(data)
+                return
+            if in_tag: end += 1
+            self.pending.append(data[:end])
+            token = "".join(self.pending)
+            self.pending = []
+            if in_tag:
+                self.add_tag(token[1:-1])
             else:
-                text += c
-        if not in_angle and text:
-            self.add_text(text)
+                self.add_text(token)
+            data = data[end:]
+        i = self.tokenize(data, False)
+        if i < len(data):
+            self.pending = [data[i:]]
+
+    def close(self):
+        self.tokenize("".join(self.pending), True)
+        self.pending = []
         return self.finish()
 
+    # consume complete tokens from body and return where the unconsumed tail starts
+    def tokenize(self, body, final):
+        i = 0
+        while True:
+            start = body.find("<", i)
+            if start == -1:
+                # text may continue in the next chunk
+                if not final: return i
+                if i < len(body): self.add_text(body[i:])
+                return len(body)
+            if start > i: self.add_text(body[i:start])
+            end = body.find(">", start + 1)
+            if end == -1:
+                # an unterminated tag at the end of the document is dropped
+                return len(body) if final else start
+            self.add_tag(body[start + 1:end])
+            i = end + 1
+
     def get_attributes(self, text):
         parts = text.split()
-        tag = parts[0].lower()
+        tag = sys.intern(parts[0].lower())
         attributes = {}
         for attrpair in parts[1:]:
             if '=' in attrpair:
                 key, value = attrpair.split("=", 1)
                 if len(value) > 2 and value[0] in ["'", "\""]:
                     value = value[1:-1]
-                attributes[key.lower()] = value
+                attributes[sys.intern(key.lower())] = value
             else:
-                attributes[attrpair.lower()] = ''
+                attributes[sys.intern(attrpair.lower())] = ''
         return tag, attributes
 
     def html_entities(self, text):
@@ -100,7 +240,7 @@ class HTMLParser:
         text = self.html_entities(text)
         parent = self.unfinished[-1]
         node = Text(text, parent)
-        parent.children.append(node)
+        self.attach(parent, node)
 
     def add_tag(self, tag):
         if tag.startswith("!"): return
@@ -108,29 +248,64 @@ class HTMLParser:
         tag, attributes = self.get_attributes(tag)
         if tag.startswith('/'):
             if len(self.unfinished) == 1: return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            self.pop()
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
-            parent.children.append(node)
+            self.attach(parent, node)
+            self.found_element(node)
         else:
+            # attach open elements right away so a partial tree is usable
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
-            self.unfinished.append(node)
+            if parent: self.attach(parent, node)
+            self.push(node)
+            self.found_element(node)
+
+    def attach(self, parent, node):
+        parent.children.append(node)
+        # a tree that is rendered while still being parsed must lead restyle to the new node
+        mark_children_dirty(parent)
+
+    def push(self, node):
+        self.unfinished.append(node)
+        self.update_mode()
+
+    def pop(self):
+        node = self.unfinished.pop()
+        self.update_mode()
+        return node
+
+    def update_mode(self):
+        depth = len(self.unfinished)
+        if depth == 0:
+            self.mode = BEFORE_HTML
+        elif depth == 1:
+            self.mode = BEFORE_HEAD
+        elif depth == 2 and self.unfinished[1].tag == "head":
+            self.mode = IN_HEAD
+        else:
+            self.mode = IN_BODY
+
+    def found_element(self, node):
+        if self.index: self.index.add(node)
+        if not self.on_subresource: return
+        if node.tag == "script" and "src" in node.attributes:
+            self.on_subresource(node)
+        elif node.tag == "link" and "href" in node.attributes \
+                and node.attributes.get("rel") == "stylesheet":
+            self.on_subresource(node)
 
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            if self.mode == BEFORE_HTML and tag != "html":
                 self.add_tag("html")
-            elif open_tags == ['html'] and tag not in ['head', 'body', '/html']:
+            elif self.mode == BEFORE_HEAD and tag not in ['head', 'body', '/html']:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif open_tags == ['html', 'head'] and tag not in ['/head'] + self.HEAD_TAGS:
+            elif self.mode == IN_HEAD and tag != '/head' and tag not in self.HEAD_TAGS:
                 self.add_tag('/head')
             else:
                 break
@@ -138,8 +313,7 @@ class HTMLParser:
     def finish(self):
         if len(self.unfinished) == 0:
             self.add_tag('html')
-        while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
-        return self.unfinished.pop()
+        root = self.unfinished[0]
+        self.unfinished = []
+        self.update_mode()
+        return root
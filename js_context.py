@@ -1,73 +1,213 @@
+import weakref
+
 import dukpy
 
-from css_parser import CSSParser
+from css_parser import parse_selector, mark_children_dirty, mark_layout_dirty
 from helpers import tree_to_list
 from html_parser import HTMLParser
-from network import request, url_origin, resolve_url
+from network import request, url_origin, resolve_url, FETCH_SCHEDULER
+
+# dispatch_event is defined once by runtime.js; each event only evaluates this call
+EVENT_DISPATCH_CODE = "dispatch_event(dukpy.handle, dukpy.type, dukpy.epoch)"
+FLUSH_CODE = "flush_mutations()"
+XHR_DONE_CODE = "xhr_done(dukpy.id, dukpy.response, dukpy.ok, dukpy.epoch)"
+
+RUNTIME_JS = None
+
+
+# runtime.js is read once per process and shared by every context
+def runtime_js():
+    global RUNTIME_JS
+    if RUNTIME_JS is None:
+        with open("runtime.js") as f:
+            RUNTIME_JS = f.read()
+    return RUNTIME_JS
+
+
+# a handle is a slot number plus that slot's generation, so a handle
+# whose node was released never resolves to the slot's next node
+HANDLE_SLOT_BITS = 24
+
+
+class HandleTable:
+    def __init__(self):
+        # slot -> weak reference to its node, or None when free
+        self.slots = []
+        self.generations = []
+        self.free = []
+        self.node_to_handle = weakref.WeakKeyDictionary()
+
+    def get_handle(self, node):
+        handle = self.node_to_handle.get(node)
+        if handle is not None: return handle
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.slots)
+            assert slot < 1 << HANDLE_SLOT_BITS, "Too many live handles"
+            self.slots.append(None)
+            self.generations.append(0)
+        self.slots[slot] = weakref.ref(node)
+        handle = (self.generations[slot] << HANDLE_SLOT_BITS) | slot
+        self.node_to_handle[node] = handle
+        return handle
+
+    def find_handle(self, node):
+        return self.node_to_handle.get(node, -1)
+
+    # returns None for handles that were released, or whose node is gone
+    def lookup(self, handle):
+        slot = handle & ((1 << HANDLE_SLOT_BITS) - 1)
+        if slot >= len(self.slots) or self.slots[slot] is None: return None
+        if self.generations[slot] != handle >> HANDLE_SLOT_BITS: return None
+        return self.slots[slot]()
+
+    def release(self, node):
+        handle = self.node_to_handle.pop(node, None)
+        if handle is None: return None
+        slot = handle & ((1 << HANDLE_SLOT_BITS) - 1)
+        self.slots[slot] = None
+        self.generations[slot] += 1
+        self.free.append(slot)
+        return handle
+
+    # releases every handle in a detached subtree, returning them
+    def release_subtree(self, node):
+        released = []
+        for child in tree_to_list(node, []):
+            handle = self.release(child)
+            if handle is not None: released.append(handle)
+        return released
+
+    def live(self):
+        return len(self.slots) - len(self.free)
 
-EVENT_DISPATCH_CODE = "new Node(dukpy.handle).dispatchEvent(new Event(dukpy.type))"
 
 class JSContext:
     def __init__(self, tab):
         self.tab = tab
         self.interp = dukpy.JSInterpreter()
+        self.pending_xhrs = 0
 
         # js to python object mappers
-        self.node_to_handle = {}
-        self.handle_to_node = {}
-
-        self.interp.export_function("log", print)
-        self.interp.export_function("querySelectorAll",
-                                    self.querySelectorAll)
-        self.interp.export_function("getAttribute",
-                                    self.getAttribute)
-        self.interp.export_function("innerHTML_set",
-                                    self.innerHTML_set)
-        self.interp.export_function("XMLHttpRequest_send",
-                                    self.XMLHttpRequest_send)
+        self.handles = HandleTable()
+        # attribute snapshots held by js are only trusted while this is unchanged
+        self.epoch = 0
+        # calls across the dukpy boundary, by name, for this page
+        self.crossings = {}
 
-        with open("runtime.js") as f:
-            self.interp.evaljs(f.read())
+        self.export_function("log", print)
+        self.export_function("querySelectorAll",
+                             self.querySelectorAll)
+        self.export_function("getAttribute",
+                             self.getAttribute)
+        self.export_function("flush_mutations",
+                             self.flush_mutations)
+        self.export_function("XMLHttpRequest_send",
+                             self.XMLHttpRequest_send)
+
+        self.interp.evaljs(runtime_js())
+
+    def export_function(self, name, function):
+        def counted(*args):
+            self.count_crossing(name)
+            return function(*args)
+        self.interp.export_function(name, counted)
+
+    def count_crossing(self, name):
+        self.crossings[name] = self.crossings.get(name, 0) + 1
+
+    def evaljs(self, code, **kwargs):
+        self.count_crossing("evaljs")
+        return self.interp.evaljs(code, **kwargs)
 
     def run(self, code):
-        return self.interp.evaljs(code)
+        try:
+            return self.evaljs(code)
+        finally:
+            # whatever the script queued is applied even if it threw
+            self.evaljs(FLUSH_CODE)
 
     def dispatch_event(self, type, elt):
-        handle = self.node_to_handle.get(elt, -1)
-        do_default = self.interp.evaljs(EVENT_DISPATCH_CODE, type=type, handle=handle)
+        handle = self.handles.find_handle(elt)
+        do_default = self.evaljs(EVENT_DISPATCH_CODE, type=type, handle=handle, epoch=self.epoch)
         return not do_default
 
+    # called when python changes attributes that js may hold snapshots of
+    def attributes_changed(self):
+        self.epoch += 1
 
     def querySelectorAll(self, selector_text):
-        selector = CSSParser(selector_text).selector()
-        nodes = [node for node in tree_to_list(self.tab.nodes, []) if selector.matches(node)]
-        return [self.get_handle(node) for node in nodes]
+        selector = parse_selector(selector_text)
+        # only elements indexed under the rightmost key can match
+        nodes = [node for node in self.tab.dom_index.lookup(selector.key) if selector.matches(node)]
+        # attributes travel with the handles, so reading them needs no further calls
+        return [{"handle": self.get_handle(node), "attributes": node.attributes} for node in nodes]
 
     def getAttribute(self, handle, attr):
-        etl = self.handle_to_node[handle]
-        return etl.attributes.get(attr, None)
+        elt = self.handles.lookup(handle)
+        if not elt: return None
+        return elt.attributes.get(attr, None)
+
+    # returns the new epoch, and the handles released by the mutations
+    # so that js can drop their listeners
+    def flush_mutations(self, mutations):
+        released = []
+        for handle, s in mutations:
+            released.extend(self.innerHTML_set(handle, s))
+        self.attributes_changed()
+        return {"epoch": self.epoch, "released": released}
 
     def innerHTML_set(self, handle, s):
+        elt = self.handles.lookup(handle)
+        # the node was detached by an earlier mutation
+        if not elt: return []
         doc = HTMLParser("<html><body>" + s + "</body></html>").parse()
         new_nodes = doc.children[0].children
-        elt = self.handle_to_node[handle]
+        released = []
+        for child in elt.children:
+            self.tab.dom_index.remove_subtree(child)
+            released.extend(self.handles.release_subtree(child))
         elt.children = new_nodes
         for child in elt.children:
             child.parent = elt
-        self.tab.render()
+        self.tab.dom_index.add_children(elt)
+        # the new nodes start out style-dirty
+        mark_children_dirty(elt)
+        mark_layout_dirty(elt)
+        self.tab.set_needs_render()
+        return released
 
-    def XMLHttpRequest_send(self, method, url, body):
+    def XMLHttpRequest_send(self, method, url, body, is_async, id):
         full_url = resolve_url(url, self.tab.url)
         if url_origin(full_url) != url_origin(self.tab.url):
             raise Exception("Cross-origin XHR request not allowed")
-        headers, out = request(full_url, self.tab.url, body)
-        return out
+        if not is_async:
+            headers, out = request(full_url, self.tab.url, body)
+            return out
+        # the request runs on the fetch pool; its result comes back as a task on the tab
+        self.pending_xhrs += 1
+        fetch = FETCH_SCHEDULER.fetch(full_url, self.tab.url, body)
+        fetch.add_done_callback(
+            lambda fetch: self.tab.schedule_task(self.XMLHttpRequest_done, id, fetch))
+
+    def XMLHttpRequest_done(self, id, fetch):
+        self.pending_xhrs -= 1
+        # the tab has navigated away from the page that made the request
+        if self.tab.js is not self: return
+        try:
+            headers, response = fetch.result()
+            ok = True
+        except Exception as e:
+            print("XHR", id, "failed", e)
+            response, ok = None, False
+        try:
+            self.evaljs(XHR_DONE_CODE, id=id, response=response, ok=ok, epoch=self.epoch)
+        except dukpy.JSRuntimeError as e:
+            print("XHR callback crashed", e)
 
     def get_handle(self, elt):
-        if elt not in self.node_to_handle:
-            handle = len(self.node_to_handle)
-            self.node_to_handle[elt] = handle
-            self.handle_to_node[handle] = elt
-        else:
-            handle = self.node_to_handle[elt]
-        return handle
\ No newline at end of file
+        return self.handles.get_handle(elt)
+
+    def live_handles(self):
+        return self.handles.live()
\ No newline at end of file
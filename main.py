@@ -1,30 +1,115 @@
+import queue
+import threading
+import time
 import tkinter
+import traceback
 import tkinter.font
 import urllib.parse
 import dukpy
+from collections import OrderedDict
 
-from helpers import tree_to_list
-from html_parser import HTMLParser, Text, Element
-from css_parser import CSSParser, style, cascade_priority
+from helpers import tree_to_list, SpatialIndex
+from html_parser import HTMLParser, DOMIndex, Text, Element
+from css_parser import CSSParser, RuleIndex, style, restyle, mark_style_dirty, cascade_priority
 from js_context import JSContext
-from network import request, resolve_url, url_origin
+from raster import TileCache
+from network import request_stream, resolve_url, url_origin, FETCH_SCHEDULER
 
 WIDTH, HEIGHT = 800, 600
 SCROLL_STEP = 100
 HSTEP, VSTEP = 13, 18
 CHROME_PX = 100
+# keep painted content on the canvas and scroll it, instead of redrawing every frame
+RETAINED_DRAWING = True
+# how far past the viewport retained drawing creates canvas items
+RETAINED_MARGIN = HEIGHT
+# composite cached raster tiles instead of issuing draw commands (needs Pillow)
+RASTER_TILES = False
+
+# one style/layout/paint per animation frame, at most
+REFRESH_RATE_MS = 16
+# how often the browser drains tab task queues, and how long one drain may take
+TASK_INTERVAL_MS = 10
+TASK_BUDGET = 0.05
+# how long a tab without a browser waits for async XHRs at the end of load()
+XHR_WAIT_TIMEOUT = 10
+# how often a page that is still loading gets its partial content painted; the interval
+# grows with the cost of the last render so partial renders take a bounded share of the load
+PARTIAL_RENDER_INTERVAL = 0.2
+PARTIAL_RENDER_BACKOFF = 4
+
+class Task:
+    def __init__(self, task_code, *args):
+        self.task_code = task_code
+        self.args = args
+
+    def run(self):
+        self.task_code(*self.args)
+
+
+class TaskRunner:
+    # tasks may be scheduled from any thread, but only ever run on the UI thread
+    def __init__(self):
+        self.tasks = queue.SimpleQueue()
+
+    def schedule_task(self, task):
+        self.tasks.put(task)
+
+    # runs queued tasks until the queue is empty or the time budget is spent;
+    # returns whether anything ran
+    def run(self, budget=TASK_BUDGET):
+        deadline = time.monotonic() + budget
+        ran = False
+        while time.monotonic() < deadline:
+            try:
+                task = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            task.run()
+            ran = True
+        return ran
+
+    # blocks until a task is scheduled, then runs it; gives up after timeout seconds
+    def run_next(self, timeout=None):
+        try:
+            task = self.tasks.get(timeout=timeout)
+        except queue.Empty:
+            return
+        task.run()
 
 
 class Tab:
-    def __init__(self):
+    # without a browser, loads run to completion before load() returns
+    def __init__(self, browser=None):
+        self.browser = browser
+        self.task_runner = TaskRunner()
         self.url = None
         self.focus = None
         self.history = []
         self.scroll = 0
+        self.nodes = None
+        self.document = None
+        self.tiles = None
+        self.js = None
+        # bumped on every navigation; work belonging to an older load is dropped
+        self.load_id = 0
+        self.loading = False
+        # the response body being read for the current load, if any
+        self.response = None
+        # mutations only request a render; it happens once per frame, or earlier
+        # when something needs up-to-date layout
+        self.needs_render = False
+        self.render_time = 0
+        self.display_list = []
+        self.display_index = SpatialIndex([], lambda cmd: (cmd.top, cmd.bottom))
+        self.hit_index = SpatialIndex([], lambda obj: (obj.y, obj.y + obj.height))
+        self.input_layouts = {}
         with open('browser.css') as f:
             self.default_style_sheet = CSSParser(f.read()).parse()
 
     def scrolldown(self):
+        self.render()
+        if not self.document: return
         max_y = self.document.height - (HEIGHT - CHROME_PX)
         self.scroll = min(self.scroll + SCROLL_STEP, max_y)
 
@@ -34,11 +119,12 @@ class Tab:
             self.scroll = 0
 
     def click(self, x, y):
+        self.render()
         self.focus = None
 
         y += self.scroll
 
-        objs = [obj for obj in tree_to_list(self.document, [])
+        objs = [obj for obj in self.hit_index.query(y, y)
                 if obj.x <= x < obj.x + obj.width
                 and obj.y <= y < obj.y + obj.height]
 
@@ -52,7 +138,9 @@ class Tab:
                 if self.js.dispatch_event('click', elt): return
                 self.focus = elt
                 elt.attributes["value"] = ""
-                return self.render()
+                self.js.attributes_changed()
+                mark_style_dirty(elt)
+                return self.set_needs_render()
             elif elt.tag == 'button':
                 if self.js.dispatch_event('click', elt): return
                 while elt:
@@ -70,21 +158,35 @@ class Tab:
     def keypress(self, char):
         if self.focus:
             self.focus.attributes['value'] += char
+            self.js.attributes_changed()
+            mark_style_dirty(self.focus)
             if self.js.dispatch_event("keydown", self.focus): return
-            self.render()
+            self.set_needs_render()
 
     def draw(self, canvas):
-        for cmd in self.display_list:
+        visible = self.display_index.query(
+            self.scroll - VSTEP, self.scroll + HEIGHT - CHROME_PX)
+        for cmd in visible:
             if cmd.top > self.scroll + HEIGHT - CHROME_PX: continue
             if cmd.bottom + VSTEP < self.scroll: continue
             cmd.execute(self.scroll - CHROME_PX, canvas)
-        if self.focus:
-            obj = [obj for obj in tree_to_list(self.document, [])
-                   if obj.node == self.focus and isinstance(obj, InputLayout)][0]
+        self.draw_cursor(canvas)
+
+    def tile_cache(self):
+        self.render()
+        if not self.tiles:
+            self.tiles = TileCache(WIDTH)
+        self.tiles.update(self.display_list, self.display_index, self.document.height)
+        return self.tiles
+
+    def draw_cursor(self, canvas, tags=()):
+        # the focused input may not have been laid out yet
+        obj = self.input_layouts.get(self.focus)
+        if obj:
             text = self.focus.attributes.get('value', '')
-            x = obj.x + obj.font.measure(text)
+            x = obj.x + measure(obj.font, text)
             y = obj.y - self.scroll + CHROME_PX
-            canvas.create_line(x, y, x, y + obj.height)
+            canvas.create_line(x, y, x, y + obj.height, tags=tags)
 
     def go_back(self):
         if len(self.history) > 1:
@@ -93,12 +195,89 @@ class Tab:
             self.load(back)
 
     def load(self, url, body=None):
-        headers, body = request(url, self.url, body)
+        self.cancel_load()
+        self.load_id += 1
+        self.loading = True
+        if not self.browser:
+            headers, chunks = request_stream(url, self.url, body)
+            try:
+                self.begin_load(self.load_id, url, headers)
+                for chunk in chunks:
+                    self.parser.feed(chunk)
+            finally:
+                chunks.close()
+            self.finish_parsing(self.load_id)
+            self.finish_load(self.load_id)
+            # with no browser loop to deliver them, async XHRs complete before load returns,
+            # unless the page keeps starting new ones
+            deadline = time.monotonic() + XHR_WAIT_TIMEOUT
+            while self.js.pending_xhrs and time.monotonic() < deadline:
+                self.task_runner.run_next(deadline - time.monotonic())
+            self.render()
+            return
+        # the network is read on a background thread; everything that touches
+        # the document happens in tasks run on the UI thread
+        thread = threading.Thread(
+            target=self.fetch_document, args=(self.load_id, url, self.url, body), daemon=True)
+        thread.start()
+
+    def cancel_load(self):
+        if not self.loading: return
+        self.load_id += 1
+        self.loading = False
+        # wakes the loading thread if it is blocked on a stalled read
+        if self.response:
+            self.response.abort()
+
+    def fetch_document(self, load_id, url, top_level_url, body):
+        try:
+            headers, chunks = request_stream(url, top_level_url, body)
+        except Exception as e:
+            self.schedule(load_id, self.fail_load, url, e)
+            return
+        if load_id == self.load_id:
+            self.response = chunks
+        # the load may have been cancelled before the response was recorded
+        if load_id != self.load_id:
+            chunks.close()
+            return
+        try:
+            self.schedule(load_id, self.begin_load, url, headers)
+            for chunk in chunks:
+                # a cancelled load stops reading; closing the stream drops its connection
+                if load_id != self.load_id: return
+                self.schedule(load_id, self.feed, chunk)
+        except Exception as e:
+            self.schedule(load_id, self.fail_load, url, e)
+            return
+        finally:
+            chunks.close()
+            if self.response is chunks:
+                self.response = None
+        self.schedule(load_id, self.finish_parsing)
+
+    def schedule_task(self, task_code, *args):
+        self.task_runner.schedule_task(Task(task_code, *args))
+
+    def schedule(self, load_id, task_code, *args):
+        self.task_runner.schedule_task(Task(self.run_for_load, load_id, task_code, *args))
+
+    def run_for_load(self, load_id, task_code, *args):
+        if load_id != self.load_id: return
+        task_code(load_id, *args)
+
+    def begin_load(self, load_id, url, headers):
         self.url = url
         self.history.append(url)
-        self.nodes = HTMLParser(body).parse()
+        self.scroll = 0
+        self.focus = None
+        self.document = None
+        self.nodes = None
         self.rules = self.default_style_sheet.copy()
+        self.rule_index = RuleIndex(sorted(self.rules, key=cascade_priority))
         self.js = JSContext(self)
+        self.last_partial_render = time.monotonic()
+        self.set_needs_render()
 
         self.allowed_origins = None
         if "content-security-policy" in headers:
@@ -106,52 +285,120 @@ class Tab:
             if len(csp) > 0 and csp[0] == 'default-src':
                 self.allowed_origins = csp[1:]
 
-        # links = [node.attributes["href"]
-        #          for node in tree_to_list(self.nodes, [])
-        #          if isinstance(node, Element)
-        #          and node.tag == "link"
-        #          and "href" in node.attributes
-        #          and node.attributes.get("rel") == "stylesheet"]
-        # for link in links:
-        #     try:
-    #             link_url = resolve_url(link, url)
-    #             if not self.allowed_request(link_url):
-        #             print("Blocked link", link, "due to CSP")
-        #             continue
-        #         header, body = request(link_url, url)
-        #     except:
-        #         continue
-        #     rules.extend(CSSParser(body).parse())
-
-        scripts = [node.attributes["src"] for node
-                   in tree_to_list(self.nodes, [])
-                   if isinstance(node, Element)
-                   and node.tag == "script"
-                   and "src" in node.attributes]
-
-        for script in scripts:
-            script_url = resolve_url(script, url)
-            if not self.allowed_request(script_url):
-                print("Blocked script", script, "due to CSP")
+        # subresource fetches start as soon as the parser sees them,
+        # and are consumed in document order once the body has arrived
+        self.stylesheets = []
+        self.scripts = []
+        self.dom_index = DOMIndex()
+        self.parser = HTMLParser(on_subresource=self.fetch_subresource, index=self.dom_index)
+
+    def feed(self, load_id, chunk):
+        self.parser.feed(chunk)
+        interval = max(PARTIAL_RENDER_INTERVAL, PARTIAL_RENDER_BACKOFF * self.render_time)
+        if time.monotonic() - self.last_partial_render > interval:
+            self.render_partial()
+            self.last_partial_render = time.monotonic()
+
+    def render_partial(self):
+        if not self.parser.unfinished: return
+        # the parser marks what it appends as dirty, so the next frame
+        # restyles and lays out only the new content
+        self.nodes = self.parser.unfinished[0]
+        self.set_needs_render()
+
+    def finish_parsing(self, load_id):
+        self.nodes = self.parser.close()
+        if not self.browser: return
+        fetches = [fetch for link, fetch in self.stylesheets + self.scripts]
+        if not fetches:
+            return self.finish_load(load_id)
+        for fetch in fetches:
+            fetch.add_done_callback(
+                lambda fetch: self.schedule(load_id, self.subresource_done))
+
+    def subresource_done(self, load_id):
+        if not self.loading: return
+        for link, fetch in self.stylesheets + self.scripts:
+            if not fetch.done(): return
+        self.finish_load(load_id)
+
+    def finish_load(self, load_id):
+        self.loading = False
+        for link, fetch in self.stylesheets:
+            try:
+                header, body = fetch.result()
+            except:
+                continue
+            self.rules.extend(CSSParser(body).parse())
+        # rules are only re-sorted when the set of stylesheets changes
+        if len(self.rules) != len(self.default_style_sheet):
+            self.rule_index = RuleIndex(sorted(self.rules, key=cascade_priority))
+            # partial renders styled the tree with the default sheet only
+            style(self.nodes, self.rule_index)
+            self.document = None
+
+        for script, fetch in self.scripts:
+            try:
+                header, body = fetch.result()
+            except Exception as e:
+                print("Script", script, "failed to load", e)
                 continue
-            header, body = request(script_url, url)
             try:
                 self.js.run(body)
             except dukpy.JSRuntimeError as e:
                 print("Script", script, "crashed", e)
 
-        self.render()
+        self.set_needs_render()
+
+    def fail_load(self, load_id, url, error):
+        self.loading = False
+        print("Failed to load", url, error)
+
+    def fetch_subresource(self, node):
+        if node.tag == "link":
+            link = node.attributes["href"]
+            link_url = resolve_url(link, self.url)
+            if not self.allowed_request(link_url):
+                print("Blocked link", link, "due to CSP")
+                return
+            self.stylesheets.append((link, FETCH_SCHEDULER.fetch(link_url, self.url)))
+        else:
+            script = node.attributes["src"]
+            script_url = resolve_url(script, self.url)
+            if not self.allowed_request(script_url):
+                print("Blocked script", script, "due to CSP")
+                return
+            self.scripts.append((script, FETCH_SCHEDULER.fetch(script_url, self.url)))
 
     def allowed_request(self, url):
         return self.allowed_origins == None or url_origin(url) in self.allowed_origins
 
+    def set_needs_render(self):
+        self.needs_render = True
+
     def render(self):
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
-        self.document = DocumentLayout(self.nodes)
+        if not self.needs_render: return
+        self.needs_render = False
+        if not self.nodes: return
+        start = time.monotonic()
+        restyle(self.nodes, self.rule_index)
+        # the layout tree is kept between renders and only dirty parts are redone
+        if not self.document:
+            self.document = DocumentLayout(self.nodes)
         self.document.layout()
         self.display_list = []
         self.document.paint(self.display_list)
 
+        # built once per paint so culling and hit testing don't scan the whole page
+        self.display_index = SpatialIndex(
+            self.display_list, lambda cmd: (cmd.top, cmd.bottom))
+        layout_objects = tree_to_list(self.document, [])
+        self.hit_index = SpatialIndex(
+            layout_objects, lambda obj: (obj.y, obj.y + obj.height))
+        self.input_layouts = {obj.node: obj for obj in layout_objects
+                              if isinstance(obj, InputLayout)}
+        self.render_time = time.monotonic() - start
+
     def submit_form(self, elt):
         if self.js.dispatch_event("submit", elt): return
 
@@ -186,6 +433,7 @@ class Browser:
         self.window.bind("<Button-1>", self.handle_click)
         self.window.bind("<Key>", self.handle_key)
         self.window.bind("<Return>", self.handle_enter)
+        self.window.bind("<Escape>", self.handle_escape)
 
         self.tabs = []
         self.active_tab = None
@@ -193,6 +441,37 @@ class Browser:
         self.focus = None
         self.address_bar = ''
 
+        # what is currently on the canvas, for retained drawing
+        self.drawn_display_list = None
+        self.drawn_scroll = 0
+        self.drawn_top = self.drawn_bottom = 0
+        self.drawn_chrome = None
+
+        self.window.after(TASK_INTERVAL_MS, self.run_tasks)
+        self.window.after(REFRESH_RATE_MS, self.animation_frame)
+
+    # both loops re-arm before doing any work, so one failing page can't stop them
+    def run_tasks(self):
+        self.window.after(TASK_INTERVAL_MS, self.run_tasks)
+        for i, tab in enumerate(self.tabs):
+            try:
+                tab.task_runner.run()
+            except Exception:
+                print("Task failed in tab", i, tab.url)
+                traceback.print_exc()
+
+    def animation_frame(self):
+        self.window.after(REFRESH_RATE_MS, self.animation_frame)
+        if not self.tabs: return
+        tab = self.tabs[self.active_tab]
+        if not tab.needs_render: return
+        try:
+            tab.render()
+            self.draw()
+        except Exception:
+            print("Render failed in tab", self.active_tab, tab.url)
+            traceback.print_exc()
+
     def handle_down(self, e):
         self.tabs[self.active_tab].scrolldown()
         self.draw()
@@ -233,53 +512,107 @@ class Browser:
             self.focus = None
             self.draw()
 
+    def handle_escape(self, e):
+        # stops the active tab's navigation, keeping whatever has been shown so far
+        self.tabs[self.active_tab].cancel_load()
+
     def handle_up(self, e):
         self.tabs[self.active_tab].scrollup()
         self.draw()
 
     def draw(self):
-        self.canvas.delete("all")
-        self.tabs[self.active_tab].draw(self.canvas)
+        tab = self.tabs[self.active_tab]
+        if RASTER_TILES:
+            self.draw_tiles(tab)
+        elif RETAINED_DRAWING:
+            self.draw_retained(tab)
+        else:
+            self.canvas.delete("all")
+            tab.draw(self.canvas)
+            self.drawn_chrome = None
+        self.draw_chrome()
+
+    def draw_retained(self, tab):
+        # content items are only created for a window around the viewport and live on
+        # the canvas until the next paint; scrolling moves them until it leaves the window
+        bottom = tab.scroll + HEIGHT - CHROME_PX
+        if self.drawn_display_list is not tab.display_list or \
+                tab.scroll - VSTEP < self.drawn_top or bottom > self.drawn_bottom:
+            self.canvas.delete("content")
+            self.drawn_top = tab.scroll - RETAINED_MARGIN
+            self.drawn_bottom = bottom + RETAINED_MARGIN
+            for cmd in tab.display_index.query(self.drawn_top, self.drawn_bottom):
+                cmd.execute(tab.scroll - CHROME_PX, self.canvas, "content")
+            self.drawn_display_list = tab.display_list
+            self.drawn_scroll = tab.scroll
+            self.canvas.tag_raise("chrome")
+        elif tab.scroll != self.drawn_scroll:
+            self.canvas.move("content", 0, self.drawn_scroll - tab.scroll)
+            self.drawn_scroll = tab.scroll
+        self.canvas.delete("cursor")
+        if tab.focus:
+            tab.draw_cursor(self.canvas, "cursor")
+            self.canvas.tag_lower("cursor", "chrome")
+
+    def draw_tiles(self, tab):
+        self.canvas.delete("content", "cursor")
+        self.drawn_display_list = None
+        if not tab.document: return
+        tiles = tab.tile_cache()
+        for col, row in tiles.visible(tab.scroll, tab.scroll + HEIGHT - CHROME_PX):
+            self.canvas.create_image(
+                col * tiles.tile_size,
+                row * tiles.tile_size - tab.scroll + CHROME_PX,
+                image=tiles.photo(col, row), anchor="nw", tags="content")
+        tab.draw_cursor(self.canvas, "cursor")
+        self.canvas.tag_raise("chrome")
+
+    def draw_chrome(self):
+        state = (self.active_tab, len(self.tabs), self.focus, self.address_bar,
+                 self.tabs[self.active_tab].url)
+        if state == self.drawn_chrome: return
+        self.drawn_chrome = state
+        self.canvas.delete("chrome")
         self.canvas.create_rectangle(0, 0, WIDTH, CHROME_PX,
-                                     fill="white", outline="black")
+                                     fill="white", outline="black", tags="chrome")
         tabfont = get_font(20, 'normal', 'roman')
         for i, tab in enumerate(self.tabs):
             name = 'Tab {}'.format(i)
             x1 = 40 + 80 * i
             x2 = 120 + 80 * i
-            self.canvas.create_line(x1, 0, x1, 40, fill='black')
-            self.canvas.create_line(x2, 0, x2, 40, fill='black')
-            self.canvas.create_text(x1 + 10, 10, anchor="nw", text=name, font=tabfont, fill="black")
+            self.canvas.create_line(x1, 0, x1, 40, fill='black', tags='chrome')
+            self.canvas.create_line(x2, 0, x2, 40, fill='black', tags='chrome')
+            self.canvas.create_text(x1 + 10, 10, anchor="nw", text=name, font=tabfont, fill="black", tags="chrome")
             if i == self.active_tab:
-                self.canvas.create_line(0, 40, x1, 40, fill="black")
-                self.canvas.create_line(x2, 40, WIDTH, 40, fill="black")
+                self.canvas.create_line(0, 40, x1, 40, fill="black", tags="chrome")
+                self.canvas.create_line(x2, 40, WIDTH, 40, fill="black", tags="chrome")
 
             # new tab button
             buttonfont = get_font(30, "normal", "roman")
-            self.canvas.create_rectangle(10, 10, 30, 30, outline="black", width=1)
-            self.canvas.create_text(11, 0, anchor="nw", text="+", font=buttonfont, fill="black")
+            self.canvas.create_rectangle(10, 10, 30, 30, outline="black", width=1, tags="chrome")
+            self.canvas.create_text(11, 0, anchor="nw", text="+", font=buttonfont, fill="black", tags="chrome")
 
             # url bar
             self.canvas.create_rectangle(40, 50, WIDTH - 10, 90,
-                                         outline="black", width=1)
+                                         outline="black", width=1, tags="chrome")
             if self.focus == 'address_bar':
                 self.canvas.create_text(55, 55, anchor='nw', text=self.address_bar,
-                                        font=buttonfont, fill="black")
+                                        font=buttonfont, fill="black", tags="chrome")
                 w = buttonfont.measure(self.address_bar)
-                self.canvas.create_line(55 + w, 55, 55 + w, 85, fill="black")
+                self.canvas.create_line(55 + w, 55, 55 + w, 85, fill="black", tags="chrome")
             else:
                 url = self.tabs[self.active_tab].url
                 self.canvas.create_text(55, 55, anchor='nw', text=url,
-                                        font=buttonfont, fill="black")
+                                        font=buttonfont, fill="black", tags="chrome")
 
             # back button
             self.canvas.create_rectangle(10, 50, 35, 90,
-                                         outline="black", width=1)
+                                         outline="black", width=1, tags="chrome")
             self.canvas.create_polygon(
-                15, 70, 30, 55, 30, 85, fill='black')
+                15, 70, 30, 55, 30, 85, fill='black', tags='chrome')
 
     def load(self, url):
-        new_tab = Tab()
+        new_tab = Tab(self)
         new_tab.load(url)
         self.active_tab = len(self.tabs)
         self.tabs.append(new_tab)
@@ -292,17 +625,29 @@ class DrawText:
         self.left = x1
         self.text = text
         self.font = font
-        self.bottom = y1 + font.metrics("linespace")
+        self.bottom = y1 + font_metrics(font)["linespace"]
         self.color = color
 
-    def execute(self, scroll, canvas):
+    def as_dict(self):
+        size, weight, slant = FONT_KEYS[self.font.name]
+        return {
+            "type": "text",
+            "left": self.left,
+            "top": self.top,
+            "text": self.text,
+            "font": {"size": size, "weight": weight, "slant": slant},
+            "color": self.color,
+        }
+
+    def execute(self, scroll, canvas, tags=()):
         canvas.create_text(
             self.left,
             self.top - scroll,
             text=self.text,
             font=self.font,
             fill=self.color,
-            anchor="nw"
+            anchor="nw",
+            tags=tags
         )
 
 
@@ -314,28 +659,107 @@ class DrawRect:
         self.right = x2
         self.color = color
 
-    def execute(self, scroll, canvas):
+    def as_dict(self):
+        return {
+            "type": "rect",
+            "left": self.left,
+            "top": self.top,
+            "right": self.right,
+            "bottom": self.bottom,
+            "color": self.color,
+        }
+
+    def execute(self, scroll, canvas, tags=()):
         canvas.create_rectangle(
             self.left,
             self.top - scroll,
             self.right,
             self.bottom - scroll,
             width=0,
-            fill=self.color
+            fill=self.color,
+            tags=tags
         )
 
 
+class HeadlessFont:
+    # deterministic fixed-width metrics, so pages can be laid out without a Tk window
+    def __init__(self, size, weight, slant):
+        self.name = "headless-{}-{}-{}".format(size, weight, slant)
+        px = size * 4 / 3
+        self.char_width = px * (0.65 if weight == "bold" else 0.6)
+        self.ascent = round(px * 0.8)
+        self.descent = round(px * 0.25)
+
+    def measure(self, text):
+        return round(len(text) * self.char_width)
+
+    def metrics(self, *options):
+        metrics = {
+            "ascent": self.ascent,
+            "descent": self.descent,
+            "linespace": self.ascent + self.descent,
+            "fixed": 1,
+        }
+        if options:
+            return metrics[options[0]]
+        return metrics
+
+
+def tk_font(size, weight, slant):
+    return tkinter.font.Font(size=size, weight=weight, slant=slant)
+
+
+FONT_PROVIDER = tk_font
 FONTS = {}
+FONT_KEYS = {}
+
+
+def set_font_provider(provider):
+    global FONT_PROVIDER
+    FONT_PROVIDER = provider
+    FONTS.clear()
+    FONT_KEYS.clear()
+    MEASURE_CACHE.clear()
+    FONT_METRICS.clear()
 
 
 def get_font(size, weight, slant):
     key = (size, weight, slant)
     if key not in FONTS:
-        font = tkinter.font.Font(size=size, weight=weight, slant=slant)
+        font = FONT_PROVIDER(size, weight, slant)
         FONTS[key] = font
+        FONT_KEYS[font.name] = key
     return FONTS[key]
 
 
+# every measurement is a round trip into Tk, so widths and metrics are cached
+MEASURE_CACHE_SIZE = 50000
+MEASURE_CACHE = OrderedDict()
+FONT_METRICS = {}
+
+
+def measure(font, text):
+    key = (font.name, text)
+    width = MEASURE_CACHE.get(key)
+    if width is None:
+        width = font.measure(text)
+        MEASURE_CACHE[key] = width
+        if len(MEASURE_CACHE) > MEASURE_CACHE_SIZE:
+            MEASURE_CACHE.popitem(last=False)
+    else:
+        MEASURE_CACHE.move_to_end(key)
+    return width
+
+
+def font_metrics(font):
+    metrics = FONT_METRICS.get(font.name)
+    if metrics is None:
+        metrics = font.metrics()
+        metrics["space"] = font.measure(" ")
+        FONT_METRICS[font.name] = metrics
+    return metrics
+
+
 class DocumentLayout:
     def __init__(self, node):
         self.node = node
@@ -349,8 +773,9 @@ class DocumentLayout:
         self.width = WIDTH - 2 * HSTEP
         self.x = HSTEP
         self.y = VSTEP
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
+        if not self.children:
+            self.children.append(BlockLayout(self.node, self, None))
+        child = self.children[0]
         child.layout()
         self.height = child.height + 2 * VSTEP
 
@@ -386,6 +811,10 @@ class BlockLayout:
         self.previous = previous
         self.children = []
         self.display_list = []
+        self.x = None
+        self.y = None
+        self.width = None
+        self.height = None
 
     def paint(self, display_list):
         bgcolor = self.node.style.get('background-color', 'transparent')
@@ -405,21 +834,39 @@ class BlockLayout:
             child.paint(display_list)
 
     def layout(self):
-        self.x = self.parent.x
+        x = self.parent.x
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
-        self.width = self.parent.width
+            y = self.parent.y
+        width = self.parent.width
+
+        # nothing inside changed and the box didn't move sideways: just slide it
+        if self.height is not None and not self.node.layout_dirty \
+                and x == self.x and width == self.width:
+            if y != self.y:
+                self.shift(y - self.y)
+            return
+
+        self.x = x
+        self.y = y
+        self.width = width
 
         mode = layout_mode(self.node)
         if mode == "block":
+            old_children = {child.node: child for child in self.children}
+            self.children = []
             previous = None
             for child in self.node.children:
-                next = BlockLayout(child, self, previous)
+                next = old_children.get(child)
+                if next:
+                    next.previous = previous
+                else:
+                    next = BlockLayout(child, self, previous)
                 self.children.append(next)
                 previous = next
         else:
+            self.children = []
             self.new_line()
             self.recurse(self.node)
 
@@ -428,6 +875,11 @@ class BlockLayout:
 
         # height must be computed _after_ children layout
         self.height = sum([child.height for child in self.children])
+        self.node.layout_dirty = False
+
+    def shift(self, dy):
+        for obj in tree_to_list(self, []):
+            obj.y += dy
 
     def recurse(self, node):
         if isinstance(node, Text):
@@ -451,7 +903,7 @@ class BlockLayout:
     def text(self, node):
         font = self.get_font(node)
         for word in node.text.split():
-            width = font.measure(word)
+            width = measure(font, word)
             if self.cursor_x + width > self.width:
                 self.new_line()
 
@@ -460,7 +912,7 @@ class BlockLayout:
             line.children.append(text)
             self.previous_word = text
 
-            self.cursor_x += width + font.measure(" ")
+            self.cursor_x += width + font_metrics(font)["space"]
 
     def input(self, node):
         width = INPUT_WIDTH_PX
@@ -471,7 +923,7 @@ class BlockLayout:
         line.children.append(input)
         self.previous_word = input
         font = self.get_font(node)
-        self.cursor_x += width + font.measure(" ")
+        self.cursor_x += width + font_metrics(font)["space"]
 
     def new_line(self):
         self.previous_word = None
@@ -500,11 +952,17 @@ class LineLayout:
         for word in self.children:
             word.layout()
 
-        max_ascent = max([word.font.metrics('ascent') for word in self.children])
+        # e.g. an element whose text hasn't arrived yet
+        if not self.children:
+            self.height = 0
+            return
+
+        metrics = [font_metrics(word.font) for word in self.children]
+        max_ascent = max([word_metrics["ascent"] for word_metrics in metrics])
         baseline = self.y + 1.25 * max_ascent
-        for word in self.children:
-            word.y = baseline - word.font.metrics('ascent')
-        max_descent = max([word.font.metrics("descent") for word in self.children])
+        for word, word_metrics in zip(self.children, metrics):
+            word.y = baseline - word_metrics["ascent"]
+        max_descent = max([word_metrics["descent"] for word_metrics in metrics])
         self.height = 1.25 * (max_ascent + max_descent)
 
     def paint(self, display_list):
@@ -527,14 +985,14 @@ class TextLayout:
         size = int(float(self.node.style["font-size"][:-2]) * .75)
         self.font = get_font(size, weight, style)
 
-        self.width = self.font.measure(self.word)
+        self.width = measure(self.font, self.word)
         if self.previous:
-            space = self.previous.font.measure(' ')
+            space = font_metrics(self.previous.font)["space"]
             self.x = self.previous.x + self.previous.width + space
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics('linespace')
+        self.height = font_metrics(self.font)["linespace"]
 
     def paint(self, display_list):
         color = self.node.style["color"]
@@ -561,12 +1019,12 @@ class InputLayout:
 
         self.width = INPUT_WIDTH_PX
         if self.previous:
-            space = self.previous.font.measure(' ')
+            space = font_metrics(self.previous.font)["space"]
             self.x = self.previous.x + self.previous.width + space
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics('linespace')
+        self.height = font_metrics(self.font)["linespace"]
 
     def paint(self, display_list):
         bgcolor = self.node.style.get("background-color",
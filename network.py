@@ -1,5 +1,14 @@
+import codecs
+import hashlib
+import json
+import os
 import socket
 import ssl
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 COOKIE_JAR = {}
 
@@ -17,16 +26,122 @@ def parse_url(url):
     return scheme, host, "/" + path
 
 
+ACCEPT_ENCODING = "gzip, deflate"
+READ_SIZE = 64 * 1024
+
+MAX_CONNECTIONS_PER_HOST = 6
+IDLE_TIMEOUT = 30
+# a stalled server fails the request instead of holding its slot forever
+READ_TIMEOUT = 30
+
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile("rb")
+        self.last_used = time.monotonic()
+        self.reused = False
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class ConnectionPool:
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, idle_timeout=IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl.create_default_context()
+        self.lock = threading.Lock()
+        # (scheme, host, port) -> idle connections, most recently used last
+        self.idle = {}
+        self.slots = {}
+        self.tls_sessions = {}
+
+    def acquire(self, scheme, host, port, reuse=True):
+        key = (scheme, host, port)
+        with self.lock:
+            slots = self.slots.setdefault(
+                key, threading.BoundedSemaphore(self.max_per_host))
+        slots.acquire()
+        try:
+            conn = self.take_idle(key) if reuse else None
+            if not conn:
+                conn = self.connect(key)
+        except:
+            slots.release()
+            raise
+        return conn
+
+    def take_idle(self, key):
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if now - conn.last_used < self.idle_timeout:
+                    conn.reused = True
+                    return conn
+                conn.close()
+        return None
+
+    def connect(self, key):
+        scheme, host, port = key
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        s.settimeout(READ_TIMEOUT)
+        s.connect((host, port))
+
+        if scheme == "https":
+            s = self.ssl_context.wrap_socket(
+                s, server_hostname=host, session=self.tls_sessions.get(key))
+            self.tls_sessions[key] = s.session
+
+        return Connection(s)
+
+    def release(self, key, conn, keep_alive):
+        if keep_alive:
+            conn.last_used = time.monotonic()
+            conn.reused = False
+            with self.lock:
+                self.idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        self.slots[key].release()
+
+    def close_all(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
+
+
+POOL = ConnectionPool()
+
+
 def request(url, top_level_url, payload=None):
+    headers, chunks = request_stream(url, top_level_url, payload)
+    try:
+        return headers, "".join(chunks)
+    finally:
+        chunks.close()
+
+
+def request_stream(url, top_level_url, payload=None):
     (scheme, host, path) = parse_url(url)
-    assert scheme in ["http", "https"], \
+    assert scheme in ["http", "https", "file"], \
         "Unknown scheme {}".format(scheme)
 
-    s = socket.socket(
-        family=socket.AF_INET,
-        type=socket.SOCK_STREAM,
-        proto=socket.IPPROTO_TCP,
-    )
+    if scheme == "file":
+        # only local pages (or a top-level load) may read local files
+        assert top_level_url is None or top_level_url.startswith("file:"), \
+            "Blocked file: request from {}".format(top_level_url)
+        with open(path, encoding="utf8") as f:
+            return {}, ResponseStream([f.read()])
 
     port = 80 if scheme == "http" else 443
 
@@ -34,15 +149,22 @@ def request(url, top_level_url, payload=None):
         host, port = host.split(":", 1)
         port = int(port)
 
-    s.connect((host, port))
-
-    if scheme == "https":
-        ctx = ssl.create_default_context()
-        s = ctx.wrap_socket(s, server_hostname=host)
-
     method = "POST" if payload else "GET"
 
-    body = "{} {} HTTP/1.0\r\n".format(method, path) + "HOST: {}\r\n".format(host)
+    cached = None
+    if method == "GET":
+        cached = CACHE.lookup(url)
+        if cached and cached.is_fresh():
+            CACHE.hits += 1
+            return cached.headers, ResponseStream([cached.body])
+    else:
+        CACHE.remove(url)
+
+    body = "{} {} HTTP/1.1\r\n".format(method, path) + "HOST: {}\r\n".format(host)
+    body += "Accept-Encoding: {}\r\n".format(ACCEPT_ENCODING)
+    if cached:
+        for header, value in cached.validators().items():
+            body += "{}: {}\r\n".format(header, value)
     if payload:
         length = len(payload.encode('utf8'))
         body += 'Content-Length: {}\r\n'.format(length)
@@ -60,38 +182,370 @@ def request(url, top_level_url, payload=None):
 
     body += "\r\n" + (payload if payload else "")
 
-    s.send(body.encode('utf8'))
+    origin = (scheme, host, port)
+    # a request that is not safe to repeat never goes out on an idle connection,
+    # which the server may have closed after reading it
+    idempotent = method == "GET"
+    conn = POOL.acquire(scheme, host, port, reuse=idempotent)
+    try:
+        try:
+            response = send_request(conn, body)
+        except (ConnectionError, EOFError):
+            if not conn.reused or not idempotent: raise
+            # the server closed an idle connection on us; retry on a fresh one
+            conn.close()
+            conn = POOL.connect(origin)
+            response = send_request(conn, body)
+
+        version, status, explanation, headers, keep_alive = response
+        assert status == "200" or (cached and status == "304"), \
+            "{}: {}".format(status, explanation)
+
+        if 'set-cookie' in headers:
+            cookie = headers['set-cookie']
+            params = {}
+            if ';' in cookie:
+                cookie, rest = cookie.split(';', 1)
+                for param_pair in rest.split(';'):
+                    key, value = param_pair.strip().split('=', 1)
+                    params[key.lower()] = value.lower()
+            COOKIE_JAR[host] = (cookie, params)
+
+    except:
+        POOL.release(origin, conn, False)
+        raise
+
+    if status == "304":
+        POOL.release(origin, conn, keep_alive)
+        CACHE.revalidations += 1
+        entry = CACHE.refresh(url, cached, headers)
+        return entry.headers, ResponseStream([entry.body])
+
+    chunked = headers.get("transfer-encoding", "").lower() == "chunked"
+    if not chunked and "content-length" not in headers:
+        keep_alive = False
+
+    if method == "GET":
+        CACHE.misses += 1
+    chunks = stream_body(conn, headers)
+    store_url = url if method == "GET" else None
+    return headers, ResponseStream(chunks, origin, conn, keep_alive, store_url, headers)
+
 
-    response = s.makefile("r", encoding="utf8", newline="\r\n")
+def stream_body(conn, headers):
+    chunks = read_body(conn.file, headers)
+    if "content-encoding" in headers:
+        chunks = decompress(chunks, headers["content-encoding"].lower())
+    decoder = codecs.getincrementaldecoder("utf8")()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text: yield text
+    text = decoder.decode(b"", True)
+    if text: yield text
 
-    statusline = response.readline()
+
+class ResponseStream:
+    # iterates over a response body. the connection goes back to the pool once the
+    # body is fully read; close() gives it up in any other case, read or not
+    def __init__(self, chunks, origin=None, conn=None, keep_alive=False,
+                 store_url=None, headers=None):
+        self.chunks = chunks
+        self.origin = origin
+        self.conn = conn
+        self.keep_alive = keep_alive
+        # a fully read body is offered to the cache under this url
+        self.store_url = store_url
+        self.headers = headers
+        self.aborted = False
+
+    def __iter__(self):
+        parts = []
+        try:
+            for chunk in self.chunks:
+                if self.store_url: parts.append(chunk)
+                yield chunk
+        except:
+            self.release(False)
+            raise
+        # an aborted read-to-close body ends early without an error
+        if self.aborted:
+            self.release(False)
+            return
+        self.release(self.keep_alive)
+        if self.store_url:
+            CACHE.store(self.store_url, self.headers, "".join(parts))
+
+    def close(self):
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+        self.release(False)
+
+    # unblocks a read in progress on another thread, which then fails and releases
+    def abort(self):
+        self.aborted = True
+        conn = self.conn
+        if not conn: return
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def release(self, keep_alive):
+        conn, self.conn = self.conn, None
+        if conn:
+            POOL.release(self.origin, conn, keep_alive)
+
+
+def send_request(conn, body):
+    conn.sock.sendall(body.encode('utf8'))
+
+    statusline = conn.file.readline().decode("utf8")
+    if not statusline:
+        raise EOFError("Connection closed before response")
     version, status, explanation = statusline.split(" ", 2)
-    assert status == "200", "{}: {}".format(status, explanation)
 
     headers = {}
     while True:
-        line = response.readline()
-        if line == "\r\n": break
+        line = conn.file.readline().decode("utf8")
+        if line in ("\r\n", "\n", ""): break
         header, value = line.split(":", 1)
         headers[header.lower()] = value.strip()
 
-    assert "transfer-encoding" not in headers
-    assert "content-encoding" not in headers
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        keep_alive = connection == "keep-alive"
+    else:
+        keep_alive = connection != "close"
+
+    return version, status, explanation, headers, keep_alive
+
+
+def read_body(file, headers):
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            line = file.readline()
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            if size == 0: break
+            yield read_exactly(file, size)
+            file.readline()
+        # skip any trailer headers
+        while file.readline() not in (b"\r\n", b"\n", b""):
+            pass
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            chunk = file.read1(min(remaining, READ_SIZE))
+            if not chunk:
+                raise EOFError("Connection closed with {} bytes unread".format(remaining))
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        while True:
+            chunk = file.read1(READ_SIZE)
+            if not chunk: break
+            yield chunk
+
+
+def decompress(chunks, encoding):
+    if encoding == "identity":
+        yield from chunks
+        return
+    assert encoding in ["gzip", "deflate"], \
+        "Unknown content-encoding {}".format(encoding)
+
+    if encoding == "gzip":
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decoder = zlib.decompressobj()
+    first = True
+    for chunk in chunks:
+        try:
+            out = decoder.decompress(chunk)
+        except zlib.error:
+            # some servers send raw deflate data without the zlib header
+            if not (first and encoding == "deflate"): raise
+            decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            out = decoder.decompress(chunk)
+        first = False
+        if out: yield out
+    out = decoder.flush()
+    if out: yield out
+
+
+def read_exactly(file, length):
+    body = file.read(length)
+    if len(body) < length:
+        raise EOFError("Connection closed with {} of {} bytes read".format(
+            len(body), length))
+    return body
+
+
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+
+
+def parse_cache_control(value):
+    directives = {}
+    for directive in value.split(","):
+        directive = directive.strip().lower()
+        if not directive: continue
+        if "=" in directive:
+            key, arg = directive.split("=", 1)
+            directives[key.strip()] = arg.strip().strip('"')
+        else:
+            directives[directive] = None
+    return directives
+
+
+class CacheEntry:
+    def __init__(self, headers, body, stored_at):
+        self.headers = headers
+        self.body = body
+        self.stored_at = stored_at
+        self.size = len(body.encode("utf8")) + \
+            sum(len(k) + len(v) for k, v in headers.items())
+
+        directives = parse_cache_control(headers.get("cache-control", ""))
+        self.no_store = "no-store" in directives
+        self.no_cache = "no-cache" in directives
+        try:
+            self.max_age = int(directives["max-age"])
+        except (KeyError, TypeError, ValueError):
+            self.max_age = None
+
+    def is_fresh(self):
+        if self.no_cache or self.max_age is None: return False
+        return time.time() - self.stored_at < self.max_age
+
+    def validators(self):
+        validators = {}
+        if "etag" in self.headers:
+            validators["If-None-Match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            validators["If-Modified-Since"] = self.headers["last-modified"]
+        return validators
+
+    def cacheable(self):
+        if self.no_store: return False
+        return bool(self.max_age) or bool(self.validators())
+
+
+class HTTPCache:
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.lock = threading.Lock()
+        # url -> CacheEntry, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry:
+                self.entries.move_to_end(url)
+                return entry
+        entry = self.load(url)
+        if entry:
+            self.insert(url, entry)
+        return entry
+
+    def store(self, url, headers, body):
+        entry = CacheEntry(headers, body, time.time())
+        if not entry.cacheable() or entry.size > self.max_bytes:
+            self.remove(url)
+            return None
+        self.insert(url, entry)
+        self.save(url, entry)
+        return entry
+
+    def refresh(self, url, entry, headers):
+        # a 304 carries updated metadata for the body we already have
+        merged = dict(entry.headers)
+        for header, value in headers.items():
+            if header not in ["content-length", "transfer-encoding", "content-encoding"]:
+                merged[header] = value
+        return self.store(url, merged, entry.body) or CacheEntry(merged, entry.body, time.time())
+
+    def insert(self, url, entry):
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old:
+                self.size -= old.size
+            self.entries[url] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def remove(self, url):
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old:
+                self.size -= old.size
+        if self.directory:
+            try:
+                os.remove(self.path(url))
+            except FileNotFoundError:
+                pass
+
+    def path(self, url):
+        name = hashlib.sha1(url.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def load(self, url):
+        if not self.directory: return None
+        try:
+            with open(self.path(url)) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get("url") != url: return None
+        return CacheEntry(saved["headers"], saved["body"], saved["stored_at"])
+
+    def save(self, url, entry):
+        if not self.directory: return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(url), "w") as f:
+            json.dump({
+                "url": url,
+                "headers": entry.headers,
+                "body": entry.body,
+                "stored_at": entry.stored_at,
+            }, f)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+
+CACHE = HTTPCache()
+
+
+MAX_CONCURRENT_FETCHES = 8
+
+
+class FetchScheduler:
+    def __init__(self, max_workers=MAX_CONCURRENT_FETCHES):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def fetch(self, url, top_level_url, payload=None):
+        return self.executor.submit(request, url, top_level_url, payload)
 
-    if 'set-cookie' in headers:
-        cookie = headers['set-cookie']
-        params = {}
-        if ';' in cookie:
-            cookie, rest = cookie.split(';', 1)
-            for param_pair in rest.split(';'):
-                key, value = param_pair.strip().split('=', 1)
-                params[key.lower()] = value.lower()
-        COOKIE_JAR[host] = (cookie, params)
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
-    body = response.read()
-    s.close()
 
-    return headers, body
+# shared by subresource loads and scripts' asynchronous XHRs
+FETCH_SCHEDULER = FetchScheduler()
 
 
 def resolve_url(url, current):
@@ -0,0 +1,121 @@
+import base64
+import io
+import json
+import tkinter
+
+try:
+    from PIL import Image, ImageColor, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+TILE_SIZE = 256
+
+
+class TileCache:
+    # paints the display list into fixed-size tiles; a tile is only re-rasterized
+    # when the commands covering it change between paints
+    def __init__(self, width, tile_size=TILE_SIZE):
+        assert Image, "Raster tiles need Pillow (pip install pillow)"
+        self.width = width
+        self.tile_size = tile_size
+        self.display_list = None
+        self.height = 0
+        # (col, row) -> signature of the commands that cover the tile
+        self.signatures = {}
+        # (col, row) -> (signature, image)
+        self.images = {}
+        # (col, row) -> (signature, Tk photo image)
+        self.photos = {}
+        self.fonts = {}
+
+    def update(self, display_list, display_index, height):
+        if display_list is self.display_list: return
+        self.display_list = display_list
+        self.height = height
+        self.commands = {}
+        self.signatures = {}
+        size = self.tile_size
+        for row in range(self.rows()):
+            top, bottom = row * size, (row + 1) * size
+            in_row = [cmd for cmd in display_index.query(top, bottom)
+                      if cmd.top < bottom and cmd.bottom > top]
+            for col in range(self.cols()):
+                left, right = col * size, (col + 1) * size
+                cmds = [cmd for cmd in in_row
+                        if cmd.left < right and getattr(cmd, "right", self.width) > left]
+                self.commands[col, row] = cmds
+                self.signatures[col, row] = hash(tuple(
+                    json.dumps(cmd.as_dict(), sort_keys=True) for cmd in cmds))
+        for cache in [self.images, self.photos]:
+            for key in list(cache):
+                if cache[key][0] != self.signatures.get(key):
+                    del cache[key]
+
+    def rows(self):
+        return int(self.height // self.tile_size) + 1
+
+    def cols(self):
+        return int((self.width - 1) // self.tile_size) + 1
+
+    def visible(self, top, bottom):
+        first = max(int(top // self.tile_size), 0)
+        last = min(int(bottom // self.tile_size), self.rows() - 1)
+        return [(col, row) for row in range(first, last + 1) for col in range(self.cols())]
+
+    def tile(self, col, row):
+        signature = self.signatures[col, row]
+        cached = self.images.get((col, row))
+        if cached and cached[0] == signature:
+            return cached[1]
+        image = self.rasterize(col, row)
+        self.images[col, row] = (signature, image)
+        return image
+
+    def photo(self, col, row):
+        signature = self.signatures[col, row]
+        cached = self.photos.get((col, row))
+        if cached and cached[0] == signature:
+            return cached[1]
+        out = io.BytesIO()
+        self.tile(col, row).save(out, format="PNG")
+        photo = tkinter.PhotoImage(data=base64.b64encode(out.getvalue()))
+        self.photos[col, row] = (signature, photo)
+        return photo
+
+    def rasterize(self, col, row):
+        size = self.tile_size
+        x0, y0 = col * size, row * size
+        image = Image.new("RGB", (size, size), "white")
+        draw = ImageDraw.Draw(image)
+        for cmd in self.commands[col, row]:
+            spec = cmd.as_dict()
+            color = spec["color"]
+            try:
+                ImageColor.getrgb(color)
+            except ValueError:
+                color = "black"
+            if spec["type"] == "rect":
+                draw.rectangle([spec["left"] - x0, spec["top"] - y0,
+                                spec["right"] - x0 - 1, spec["bottom"] - y0 - 1], fill=color)
+            else:
+                font = self.font(spec["font"]["size"])
+                # an input without a value paints no text
+                draw.text((spec["left"] - x0, spec["top"] - y0), spec["text"] or "",
+                          fill=color, font=font)
+        return image
+
+    def font(self, size):
+        if size not in self.fonts:
+            try:
+                self.fonts[size] = ImageFont.load_default(size=size * 4 / 3)
+            except TypeError:
+                # older Pillow only has the fixed-size bitmap font
+                self.fonts[size] = ImageFont.load_default()
+        return self.fonts[size]
+
+    def composite(self, top, bottom):
+        size = self.tile_size
+        image = Image.new("RGB", (self.width, int(bottom - top)), "white")
+        for col, row in self.visible(top, bottom):
+            image.paste(self.tile(col, row), (col * size, row * size - int(top)))
+        return image
@@ -4,18 +4,49 @@ console = {
     }
 }
 
+// mutations are queued and sent to python in one call, before the next read
+// or at the end of the current task
+var pending_mutations = []
+// python bumps the epoch whenever attributes may have changed
+var epoch = 0
+
+function flush_mutations() {
+    if (!pending_mutations.length) return
+    var mutations = pending_mutations
+    pending_mutations = []
+    var result = call_python("flush_mutations", mutations)
+    epoch = result.epoch
+    // nodes detached by the mutations can never be dispatched to again
+    for (var i = 0; i < result.released.length; i++) {
+        delete listeners[result.released[i]]
+    }
+}
+
 document = {
     querySelectorAll: function(s) {
-        var handles = call_python("querySelectorAll", s);
-        return handles.map(function(handle) { return new Node(handle) })
+        flush_mutations()
+        var snapshots = call_python("querySelectorAll", s);
+        return snapshots.map(function(snapshot) {
+            return new Node(snapshot.handle, snapshot.attributes)
+        })
     }
 }
 
 var listeners = {}
 
-function Node(handle) { this.handle = handle; }
+function Node(handle, attributes) {
+    this.handle = handle;
+    this.attributes = attributes;
+    this.epoch = epoch;
+}
 
 Node.prototype.getAttribute = function(attr) {
+    flush_mutations()
+    if (this.attributes && this.epoch == epoch) {
+        // missing attributes come back as undefined, as they do from python
+        if (Object.prototype.hasOwnProperty.call(this.attributes, attr)) return this.attributes[attr];
+        return undefined;
+    }
     return call_python("getAttribute", this.handle, attr);
 }
 
@@ -38,10 +69,19 @@ Node.prototype.dispatchEvent = function(event) {
 
 Object.defineProperty(Node.prototype, 'innerHTML', {
     set: function(s) {
-        call_python('innerHTML_set', this.handle, s.toString())
+        pending_mutations.push([this.handle, s.toString()])
     }
 })
 
+function dispatch_event(handle, type, python_epoch) {
+    epoch = python_epoch
+    try {
+        return new Node(handle).dispatchEvent(new Event(type))
+    } finally {
+        flush_mutations()
+    }
+}
+
 function Event(type) {
     this.type = type
     this.do_default = true
@@ -53,12 +93,42 @@ Event.prototype.preventDefault = function() {
 
 function XMLHttpRequest() {}
 
+// async requests waiting for python to report completion, by id
+var pending_xhrs = {}
+var next_xhr_id = 0
+
 XMLHttpRequest.prototype.open = function(method, url, is_async) {
-    if (is_async) throw new Error('async not implemented yet')
     this.method = method
     this.url = url
+    this.is_async = is_async
+    this.readyState = 1
 }
 
 XMLHttpRequest.prototype.send = function(body) {
-    this.responseText = call_python('XMLHttpRequest_send', this.method, this.url, body)
-}
\ No newline at end of file
+    flush_mutations()
+    if (!this.is_async) {
+        this.responseText = call_python('XMLHttpRequest_send', this.method, this.url, body, false, -1)
+        this.readyState = 4
+        this.status = 200
+        return
+    }
+    var id = next_xhr_id++
+    pending_xhrs[id] = this
+    call_python('XMLHttpRequest_send', this.method, this.url, body, true, id)
+}
+
+function xhr_done(id, response, ok, python_epoch) {
+    epoch = python_epoch
+    var xhr = pending_xhrs[id]
+    delete pending_xhrs[id]
+    try {
+        xhr.readyState = 4
+        xhr.status = ok ? 200 : 0
+        if (ok) xhr.responseText = response
+        if (xhr.onreadystatechange) xhr.onreadystatechange()
+        if (ok && xhr.onload) xhr.onload()
+        if (!ok && xhr.onerror) xhr.onerror()
+    } finally {
+        flush_mutations()
+    }
+}